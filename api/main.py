@@ -1,21 +1,44 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.responses import JSONResponse
+import asyncio
+import hashlib
 import logging
 import os
 from datetime import datetime
-import sys
-import pytz
+from typing import Optional
 
-# パスを追加してservicesモジュールをインポート
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
-from services.csv_generator import generate_csv_data, generate_filename
-from services.ftp_client import upload_csv_to_ftp
+# servicesパッケージはプロジェクトルート（uvicorn/Vercelの実行ディレクトリ）から解決される
+from services.csv_generator import JST, generate_csv_data, generate_filename, generate_catchup_files
+from services.ftp_client import get_shared_client, upload_csv_to_ftp_async
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _services_log_level() -> int:
+    """
+    servicesパッケージのログレベルを環境変数から取得
+    本番ではWARNINGにするとFTP処理ごとのINFOログを抑制できる
+    不明な値の場合は起動を止めずにINFOを使用
+    
+    Returns:
+        int: ログレベル
+    """
+    level_name = (os.getenv("SERVICES_LOG_LEVEL") or "INFO").upper()
+    level = logging.getLevelName(level_name)
+    if not isinstance(level, int):
+        logger.warning("Unknown SERVICES_LOG_LEVEL %r, falling back to INFO", level_name)
+        return logging.INFO
+    return level
+
+logging.getLogger("services").setLevel(_services_log_level())
+
+# キャッシュ制御ヘッダー
+# 送信・接続テストなど実行のたびに結果が変わるエンドポイントはキャッシュさせない
+NO_STORE_HEADERS = {"Cache-Control": "no-store"}
+HEALTH_CACHE_HEADERS = {"Cache-Control": "public, max-age=60, s-maxage=60"}
+SAMPLE_CSV_CACHE_HEADERS = {"Cache-Control": "public, max-age=300, s-maxage=300"}
+
 app = FastAPI(
     title="来店客数データ自動送信API",
     description="店舗の来店客数データをCSV形式でFTP送信するAPI（現在は毎日17時実行、本来は15分間隔予定）",
@@ -28,7 +51,10 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "csv-export-api"}
+    return JSONResponse(
+        content={"status": "healthy", "service": "csv-export-api"},
+        headers=HEALTH_CACHE_HEADERS
+    )
 
 @app.get("/api/cron-export")
 async def cron_csv_export():
@@ -37,43 +63,47 @@ async def cron_csv_export():
     現在は毎日17時に実行（Vercel Hobbyプラン制限）
     本来は15分間隔での実行を想定
     """
+    # CSVの内容・ファイル名・応答のタイムスタンプで同じ時刻を使用
+    now = datetime.now(JST)
     try:
         logger.info("Starting CSV export cron job")
         
         # 1. CSVデータを生成
         logger.info("Generating CSV data")
-        csv_content = generate_csv_data(data_type="current")
+        csv_content = await asyncio.to_thread(generate_csv_data, data_type="current", now=now)
         
         # 2. ファイル名を生成
-        filename = generate_filename()
-        logger.info(f"Generated filename: {filename}")
+        filename = generate_filename(now=now)
+        logger.info("Generated filename: %s", filename)
         
         # 3. FTP送信
         logger.info("Uploading CSV to FTP server")
-        upload_result = upload_csv_to_ftp(csv_content, filename)
+        upload_result = await upload_csv_to_ftp_async(csv_content, filename)
         
         # 4. 結果の処理
         if upload_result["success"]:
-            logger.info(f"CSV export successful: {filename}")
+            logger.info("CSV export successful: %s", filename)
             return JSONResponse(
                 status_code=200,
+                headers=NO_STORE_HEADERS,
                 content={
                     "status": "success",
                     "message": "CSV export completed successfully",
                     "filename": filename,
-                    "timestamp": datetime.now(pytz.timezone('Asia/Tokyo')).isoformat(),
+                    "timestamp": now.isoformat(),
                     "upload_details": upload_result
                 }
             )
         else:
-            logger.error(f"CSV export failed: {upload_result.get('message', 'Unknown error')}")
+            logger.error("CSV export failed: %s", upload_result.get('message', 'Unknown error'))
             return JSONResponse(
                 status_code=500,
+                headers=NO_STORE_HEADERS,
                 content={
                     "status": "error",
                     "message": "CSV export failed",
                     "filename": filename,
-                    "timestamp": datetime.now(pytz.timezone('Asia/Tokyo')).isoformat(),
+                    "timestamp": now.isoformat(),
                     "error_details": upload_result
                 }
             )
@@ -83,10 +113,72 @@ async def cron_csv_export():
         logger.error(error_msg)
         return JSONResponse(
             status_code=500,
+            headers=NO_STORE_HEADERS,
+            content={
+                "status": "error",
+                "message": error_msg,
+                "timestamp": now.isoformat()
+            }
+        )
+
+# 一括送信の最大時間数（48時間 = 192ファイル）
+# 1ファイルごとにSTORが直列に実行されるため、関数の実行時間上限（60秒）に収まる範囲に制限
+CATCHUP_MAX_HOURS = 48
+
+@app.get("/api/catchup-export")
+async def catchup_csv_export(hours: int = Query(24, ge=1, le=CATCHUP_MAX_HOURS)):
+    """
+    Cronの実行漏れ分の来店客数データをまとめて送信するエンドポイント
+    指定時間分のデータを15分ごとのCSVファイルに分割し、1つのFTPセッションで送信
+    現在の時刻枠とFTPサーバーに既に存在するファイルは送信しない
+    """
+    now = datetime.now(JST)
+    try:
+        logger.info("Starting catch-up CSV export for the last %s hours", hours)
+        
+        # 1. 15分ごとのCSVファイルを生成
+        files = await asyncio.to_thread(generate_catchup_files, hours_back=hours, now=now)
+        
+        # 2. FTP送信（1セッションでまとめて送信、送信済みのファイルは除外）
+        logger.info("Uploading %s CSV files to FTP server", len(files))
+        upload_result = await asyncio.to_thread(get_shared_client().upload_many, files, skip_existing=True)
+        
+        # 3. 結果の処理
+        if upload_result["success"]:
+            logger.info("Catch-up export successful: %s files", upload_result['uploaded_count'])
+            return JSONResponse(
+                status_code=200,
+                headers=NO_STORE_HEADERS,
+                content={
+                    "status": "success",
+                    "message": "Catch-up CSV export completed successfully",
+                    "timestamp": now.isoformat(),
+                    "upload_details": upload_result
+                }
+            )
+        else:
+            logger.error("Catch-up export failed: %s", upload_result['message'])
+            return JSONResponse(
+                status_code=500,
+                headers=NO_STORE_HEADERS,
+                content={
+                    "status": "error",
+                    "message": "Catch-up CSV export failed",
+                    "timestamp": now.isoformat(),
+                    "error_details": upload_result
+                }
+            )
+            
+    except Exception as e:
+        error_msg = f"Unexpected error in catch-up export: {str(e)}"
+        logger.error(error_msg)
+        return JSONResponse(
+            status_code=500,
+            headers=NO_STORE_HEADERS,
             content={
                 "status": "error",
                 "message": error_msg,
-                "timestamp": datetime.now(pytz.timezone('Asia/Tokyo')).isoformat()
+                "timestamp": now.isoformat()
             }
         )
 
@@ -96,14 +188,12 @@ async def test_ftp_connection():
     FTP接続のテストエンドポイント
     """
     try:
-        from services.ftp_client import FTPClient
-        
-        ftp_client = FTPClient()
-        test_result = ftp_client.test_connection()
+        test_result = await asyncio.to_thread(get_shared_client().test_connection)
         
         if test_result["success"]:
             return JSONResponse(
                 status_code=200,
+                headers=NO_STORE_HEADERS,
                 content={
                     "status": "success",
                     "message": "FTP connection test successful",
@@ -113,6 +203,7 @@ async def test_ftp_connection():
         else:
             return JSONResponse(
                 status_code=500,
+                headers=NO_STORE_HEADERS,
                 content={
                     "status": "error",
                     "message": "FTP connection test failed",
@@ -123,32 +214,74 @@ async def test_ftp_connection():
     except Exception as e:
         return JSONResponse(
             status_code=500,
+            headers=NO_STORE_HEADERS,
             content={
                 "status": "error",
                 "message": f"FTP test error: {str(e)}"
             }
         )
 
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-MatchヘッダーがETagに一致するか判定
+    CDNが圧縮時に付与する弱いETag（W/"..."）、カンマ区切りの複数指定、*に対応
+    
+    Args:
+        if_none_match: If-None-Matchヘッダーの値
+        etag: 現在のETag（弱いETagも可）
+        
+    Returns:
+        bool: 一致する場合True
+    """
+    if not if_none_match:
+        return False
+    # 弱い比較（W/の有無を無視して比較）
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
 @app.get("/api/generate-sample-csv")
-async def generate_sample_csv():
+async def generate_sample_csv(request: Request):
     """
     来店客数データのサンプル生成・確認用エンドポイント
+    ETagを付与し、If-None-Matchが一致する場合は304を返す
     """
     try:
+        now = datetime.now(JST)
+        
         # 現在のデータを生成
-        current_csv = generate_csv_data(data_type="current")
-        filename = generate_filename()
+        current_csv = await asyncio.to_thread(generate_csv_data, data_type="current", now=now)
+        filename = generate_filename(now=now)
         
         # 過去24時間のデータも生成
-        historical_csv = generate_csv_data(data_type="historical")
+        historical_csv = await asyncio.to_thread(generate_csv_data, data_type="historical", now=now)
+        
+        # ETagはCSVデータとファイル名から算出（いずれも15分単位でしか変わらない）
+        # JSON応答はバイト単位の同一性を保証しないため弱いETagとする
+        digest = hashlib.md5(current_csv + historical_csv + filename.encode('utf-8'), usedforsecurity=False)
+        etag = f'W/"{digest.hexdigest()}"'
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={**SAMPLE_CSV_CACHE_HEADERS, "ETag": etag})
+        
+        # プレビュー表示用に文字列へ変換
+        current_csv = current_csv.decode('utf-8')
         
         return JSONResponse(
             status_code=200,
+            headers={**SAMPLE_CSV_CACHE_HEADERS, "ETag": etag},
             content={
                 "status": "success",
                 "current_filename": filename,
                 "current_csv_preview": current_csv[:200] + "..." if len(current_csv) > 200 else current_csv,
-                "historical_csv_lines": len(historical_csv.split('\n')) - 1,  # ヘッダー除く
+                "historical_csv_lines": historical_csv.count(b'\n'),  # ヘッダー行を含む
                 "message": "Sample CSV data generated successfully"
             }
         )
@@ -156,6 +289,7 @@ async def generate_sample_csv():
     except Exception as e:
         return JSONResponse(
             status_code=500,
+            headers=NO_STORE_HEADERS,
             content={
                 "status": "error",
                 "message": f"CSV generation error: {str(e)}"
@@ -1,144 +1,274 @@
-import csv
-import io
+import functools
 from datetime import datetime, timedelta
-import random
-from typing import List, Dict
+from typing import Dict, List, Optional, Tuple
 import pytz
 
+# 日本時間（タイムゾーンの検索は初回のみ）
+JST = pytz.timezone('Asia/Tokyo')
+
+# CSVヘッダー（csvモジュールと同じCRLF改行）
+_FIELDNAMES = ("timestamp", "date", "time", "visitor_count", "day_of_week", "hour")
+_CSV_HEADER = ",".join(_FIELDNAMES) + "\r\n"
+
+# 64bit演算用のマスク
+_MASK64 = (1 << 64) - 1
+
+# 曜日名（datetime.weekday()の値で参照）
+_WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+def _floor_to_quarter_hour(timestamp: datetime) -> datetime:
+    """
+    時刻を15分単位に切り下げ（本来の15分間隔要件に合わせて）
+    
+    Args:
+        timestamp: 対象時刻
+        
+    Returns:
+        datetime: 15分単位に切り下げた時刻
+    """
+    minutes = (timestamp.minute // 15) * 15
+    return timestamp.replace(minute=minutes, second=0, microsecond=0)
+
+def _quarter_hour_slots(last_slot: datetime, hours_back: int) -> List[datetime]:
+    """
+    指定時刻枠までの過去指定時間分の15分間隔の時刻枠を生成
+    
+    Args:
+        last_slot: 最後（最新）の時刻枠
+        hours_back: 何時間分の時刻枠を生成するか
+        
+    Returns:
+        List[datetime]: 時刻枠のリスト（古い順）
+    """
+    # 古い順に並ぶよう逆順に生成し、reverseを不要にする
+    return [
+        last_slot - timedelta(minutes=15 * i)
+        for i in range(hours_back * 4 - 1, -1, -1)  # 1時間 = 4回（15分間隔）
+    ]
+
+def _slot_variation(timestamp: datetime) -> float:
+    """
+    15分枠ごとのランダム変動（±30%）を取得
+    枠の番号をハッシュ（splitmix64）して求めるため、current・historical・catchupの
+    どの経路で生成しても同じ枠は常に同じ値になる（再実行・再送信で値が変わらない）
+    
+    Args:
+        timestamp: 15分単位に切り下げた時刻
+        
+    Returns:
+        float: 0.7〜1.3の変動係数（uniform(0.7, 1.3)と同じ分布）
+    """
+    # 行ごとにrandom.Randomの状態（メルセンヌ・ツイスタ）を作らず、整数演算のみで算出
+    z = (int(timestamp.timestamp()) // 900 + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    z ^= z >> 31
+    # 上位53bitを[0, 1)の浮動小数点数に変換
+    return 0.7 + 0.6 * ((z >> 11) * (1.0 / (1 << 53)))
+
+def _make_row(timestamp: datetime, visitor_count: int) -> Tuple:
+    """
+    指定時刻の1行分のデータを生成
+    strftimeを使わずf-stringで整形する（ロケール処理を回避）
+    
+    Args:
+        timestamp: 対象時刻
+        visitor_count: 来店客数
+        
+    Returns:
+        Tuple: _FIELDNAMESの列順のデータ
+    """
+    date = f"{timestamp.year:04d}-{timestamp.month:02d}-{timestamp.day:02d}"
+    time = f"{timestamp.hour:02d}:{timestamp.minute:02d}"
+    return (
+        f"{date} {time}:{timestamp.second:02d}",
+        date,
+        time,
+        visitor_count,
+        _WEEKDAYS[timestamp.weekday()],
+        timestamp.hour
+    )
+
+def _format_row(row: Tuple) -> str:
+    """
+    1行分のデータをCSV行に整形（値にカンマ・引用符を含まないため直接連結）
+    
+    Args:
+        row: _FIELDNAMESの列順のデータ
+        
+    Returns:
+        str: CRLF付きのCSV行
+    """
+    timestamp, date, time, visitor_count, day_of_week, hour = row
+    return f"{timestamp},{date},{time},{visitor_count},{day_of_week},{hour}\r\n"
+
+def _base_for_hour(base_visitors: Dict[str, int], hour: int) -> int:
+    """
+    時間帯に基づく基準来店客数を取得（平日・ランダム変動なし）
+    
+    Args:
+        base_visitors: 時間帯ごとの基準来店客数
+        hour: 対象時刻の時
+        
+    Returns:
+        int: 基準来店客数
+    """
+    # 時間帯による基準値設定
+    if 6 <= hour < 11:
+        return base_visitors["morning"]
+    elif 11 <= hour < 15:
+        return base_visitors["noon"]
+    elif 15 <= hour < 20:
+        return base_visitors["evening"]
+    else:
+        return base_visitors["night"]
+
+def _build_base_table(base_visitors: Dict[str, int]) -> Tuple[Tuple[int, ...], ...]:
+    """
+    曜日・時間ごとの基準来店客数の表を作成（[weekday()][hour]で参照）
+    
+    Args:
+        base_visitors: 時間帯ごとの基準来店客数
+        
+    Returns:
+        Tuple[Tuple[int, ...], ...]: 7曜日×24時間の基準来店客数
+    """
+    weekday_base = tuple(_base_for_hour(base_visitors, hour) for hour in range(24))
+    # 曜日による調整（土日は+20%）
+    weekend_base = tuple(int(base * 1.2) for base in weekday_base)
+    return (weekday_base,) * 5 + (weekend_base,) * 2
+
 class VisitorDataGenerator:
-    def __init__(self):
-        self.base_visitors = {
-            "morning": 15,    # 朝の基準来店客数
-            "noon": 45,       # 昼の基準来店客数
-            "evening": 30,    # 夕方の基準来店客数
-            "night": 8        # 夜の基準来店客数
-        }
-    
-    def generate_sample_data(self, hours_back: int = 24) -> List[Dict]:
+    base_visitors = {
+        "morning": 15,    # 朝の基準来店客数
+        "noon": 45,       # 昼の基準来店客数
+        "evening": 30,    # 夕方の基準来店客数
+        "night": 8        # 夜の基準来店客数
+    }
+    
+    # 計算のたびに時間帯の条件分岐をしないよう、インポート時に一度だけ作成
+    _base_table = _build_base_table(base_visitors)
+    
+    def generate_sample_data(self, hours_back: int = 24, now: Optional[datetime] = None) -> List[Tuple]:
         """
         過去指定時間分の来店客数データを生成（15分間隔）
         
         Args:
             hours_back: 何時間前からのデータを生成するか
+            now: 基準時刻（Noneの場合は現在時刻）
             
         Returns:
-            List[Dict]: 来店客数データのリスト
+            List[Tuple]: 来店客数データの行リスト（_FIELDNAMESの列順、古い順）
         """
-        data = []
-        jst = pytz.timezone('Asia/Tokyo')
-        current_time = datetime.now(jst)
-        
-        # 15分間隔で過去のデータを生成（本来の要件に合わせて）
-        for i in range(hours_back * 4):  # 1時間 = 4回（15分間隔）
-            timestamp = current_time - timedelta(minutes=15 * i)
-            visitor_count = self._calculate_visitor_count(timestamp)
-            
-            data.append({
-                "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                "date": timestamp.strftime("%Y-%m-%d"),
-                "time": timestamp.strftime("%H:%M"),
-                "visitor_count": visitor_count,
-                "day_of_week": timestamp.strftime("%A"),
-                "hour": timestamp.hour
-            })
-        
-        # 時系列順にソート（古い順）
-        data.reverse()
-        return data
+        # 15分単位に切り下げ（generate_current_dataと同じ時刻枠に揃える）
+        base_time = _floor_to_quarter_hour(now or datetime.now(JST))
+        timestamps = _quarter_hour_slots(base_time, hours_back)
+        
+        visitor_counts = map(self._calculate_visitor_count, timestamps)
+        
+        return list(map(_make_row, timestamps, visitor_counts))
     
     def _calculate_visitor_count(self, timestamp: datetime) -> int:
         """
         時間帯に基づいて来店客数を計算
         
         Args:
-            timestamp: 対象時刻
+            timestamp: 対象時刻（15分単位に切り下げた時刻）
             
         Returns:
             int: 来店客数
         """
-        hour = timestamp.hour
-        
-        # 時間帯による基準値設定
-        if 6 <= hour < 11:
-            base = self.base_visitors["morning"]
-        elif 11 <= hour < 15:
-            base = self.base_visitors["noon"]
-        elif 15 <= hour < 20:
-            base = self.base_visitors["evening"]
-        else:
-            base = self.base_visitors["night"]
-        
-        # 曜日による調整（土日は+20%）
-        if timestamp.weekday() >= 5:  # 土日
-            base = int(base * 1.2)
-        
-        # ランダム変動（±30%）
-        variation = random.uniform(0.7, 1.3)
-        visitor_count = max(0, int(base * variation))
-        
-        return visitor_count
+        return max(0, int(self._base_table[timestamp.weekday()][timestamp.hour] * _slot_variation(timestamp)))
     
-    def generate_current_data(self) -> Dict:
+    def generate_current_data(self, now: Optional[datetime] = None) -> Tuple:
         """
         現在時刻の来店客数データを生成
         
+        Args:
+            now: 基準時刻（Noneの場合は現在時刻）
+            
         Returns:
-            Dict: 現在の来店客数データ
+            Tuple: 現在の来店客数データ（_FIELDNAMESの列順）
         """
-        jst = pytz.timezone('Asia/Tokyo')
-        current_time = datetime.now(jst)
-        # 15分単位に切り下げ（本来の15分間隔要件に合わせて）
-        minutes = (current_time.minute // 15) * 15
-        adjusted_time = current_time.replace(minute=minutes, second=0, microsecond=0)
+        adjusted_time = _floor_to_quarter_hour(now or datetime.now(JST))
         
         visitor_count = self._calculate_visitor_count(adjusted_time)
         
-        return {
-            "timestamp": adjusted_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "date": adjusted_time.strftime("%Y-%m-%d"),
-            "time": adjusted_time.strftime("%H:%M"),
-            "visitor_count": visitor_count,
-            "day_of_week": adjusted_time.strftime("%A"),
-            "hour": adjusted_time.hour
-        }
+        return _make_row(adjusted_time, visitor_count)
 
-def generate_csv_data(data_type: str = "current") -> str:
+@functools.lru_cache(maxsize=8)
+def _build_csv(data_type: str, bucket_time: datetime) -> bytes:
     """
-    CSV形式のデータを生成
-    
+    CSV形式のデータを生成（15分バケット単位でキャッシュ）
+    同一バケット内の再実行・手動送信ではキャッシュ済みのCSVを返す
+
     Args:
         data_type: "current" または "historical"
-        
+        bucket_time: 15分単位に切り下げた時刻（キャッシュキー）
+
     Returns:
-        str: CSV形式の文字列
+        bytes: UTF-8でエンコード済みのCSVデータ
     """
     generator = VisitorDataGenerator()
     
     if data_type == "current":
-        data = [generator.generate_current_data()]
+        rows = [generator.generate_current_data(now=bucket_time)]
     else:
-        data = generator.generate_sample_data(hours_back=24)
+        rows = generator.generate_sample_data(hours_back=24, now=bucket_time)
     
-    # CSV文字列を生成
-    output = io.StringIO()
-    fieldnames = ["timestamp", "date", "time", "visitor_count", "day_of_week", "hour"]
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    
-    writer.writeheader()
-    writer.writerows(data)
-    
-    csv_content = output.getvalue()
-    output.close()
+    # CSVデータを生成（送信時に再エンコードしないようバイト列で返す）
+    return (_CSV_HEADER + "".join(map(_format_row, rows))).encode('utf-8')
+
+def generate_csv_data(data_type: str = "current", now: Optional[datetime] = None) -> bytes:
+    """
+    CSV形式のデータを生成
     
-    return csv_content
+    Args:
+        data_type: "current" または "historical"
+        now: 基準時刻（Noneの場合は現在時刻）
+        
+    Returns:
+        bytes: UTF-8でエンコード済みのCSVデータ
+    """
+    return _build_csv(data_type, _floor_to_quarter_hour(now or datetime.now(JST)))
 
-def generate_filename() -> str:
+def generate_filename(now: Optional[datetime] = None) -> str:
     """
     タイムスタンプ付きのCSVファイル名を生成
+    時刻は15分単位に切り下げ、CSVの行と同じ時刻枠をファイル名にする
+    （Cron・手動・一括送信のどの経路でも同じ時刻枠は同じファイル名になる）
     
+    Args:
+        now: 基準時刻（Noneの場合は現在時刻）
+        
     Returns:
         str: ファイル名
     """
-    jst = pytz.timezone('Asia/Tokyo')
-    timestamp = datetime.now(jst).strftime("%Y%m%d_%H%M")
-    return f"visitor_data_{timestamp}.csv"
\ No newline at end of file
+    slot = _floor_to_quarter_hour(now or datetime.now(JST))
+    return f"visitor_data_{slot.year:04d}{slot.month:02d}{slot.day:02d}_{slot.hour:02d}{slot.minute:02d}.csv"
+
+def generate_catchup_files(hours_back: int = 24, now: Optional[datetime] = None) -> List[Tuple[str, bytes]]:
+    """
+    過去指定時間分の来店客数データを15分ごとのCSVファイルに分割して生成
+    Cronの実行漏れ分をまとめて送信する用途のため、現在の時刻枠（Cronで送信する分）は含めない
+    
+    Args:
+        hours_back: 何時間前からのデータを生成するか
+        now: 基準時刻（Noneの場合は現在時刻）
+        
+    Returns:
+        List[Tuple[str, bytes]]: (ファイル名, UTF-8でエンコード済みのCSVデータ)のリスト（古い順）
+    """
+    generator = VisitorDataGenerator()
+    
+    # 現在の時刻枠の1つ前までを対象にする
+    last_slot = _floor_to_quarter_hour(now or datetime.now(JST)) - timedelta(minutes=15)
+    rows = generator.generate_sample_data(hours_back=hours_back, now=last_slot)
+    
+    files = []
+    for timestamp, row in zip(_quarter_hour_slots(last_slot, hours_back), rows):
+        # ファイル名はCronと同じ時刻枠単位で生成
+        filename = generate_filename(now=timestamp)
+        files.append((filename, (_CSV_HEADER + _format_row(row)).encode('utf-8')))
+    
+    return files
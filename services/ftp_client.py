@@ -1,13 +1,31 @@
+import asyncio
 import ftplib
-import io
+import gzip
 import os
 import logging
+import ssl
+import threading
+import time
 from contextlib import contextmanager
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Set, Tuple
 
 # ログ設定
 logger = logging.getLogger(__name__)
 
+# この秒数以上アイドルだった接続は使用前にNOOPで生存確認する
+KEEPALIVE_INTERVAL = 60
+
+# 制御・データ接続のソケットタイムアウト（秒）
+# 半開きの永続接続で関数の実行時間上限（60秒）まで待たされないようにする
+SOCKET_TIMEOUT = 15
+
+# 接続の切断・一時的な障害を示す例外（再接続して再試行する対象）
+# 550などの恒久的なエラー（error_perm）は再試行しても結果が変わらないため含めない
+_CONNECTION_ERRORS = (OSError, EOFError, ftplib.error_temp)
+
+class _ListingLimitReached(Exception):
+    """ディレクトリ一覧の取得件数が上限に達したことを示す"""
+
 class FTPClient:
     def __init__(self, config: Optional[Dict[str, str]] = None):
         """
@@ -25,11 +43,17 @@ class FTPClient:
                 "password": os.getenv("FTP_PASSWORD"),
                 "port": int(os.getenv("FTP_PORT", "21")),
                 "remote_dir": os.getenv("FTP_REMOTE_DIR", "/"),
-                "use_tls": os.getenv("FTP_USE_TLS", "false").lower() == "true"
+                "use_tls": os.getenv("FTP_USE_TLS", "false").lower() == "true",
+                "compress": os.getenv("FTP_COMPRESS", "false").lower() == "true"
             }
         
         # 設定値の検証
         self._validate_config()
+        
+        # 永続接続（接続・ログインのコストを複数回の処理で共有する）
+        self._ftp = None
+        self._last_use = 0.0
+        self._lock = threading.RLock()
     
     def _validate_config(self):
         """FTP設定の検証"""
@@ -38,31 +62,29 @@ class FTPClient:
             if not self.config.get(field):
                 raise ValueError(f"FTP configuration missing: {field}")
     
-    @contextmanager
-    def ftp_connection(self):
+    def _connect(self):
         """
-        FTP接続のコンテキストマネージャー
+        FTPサーバーに新規接続してログイン
         
-        Yields:
+        Returns:
             ftplib.FTP or ftplib.FTP_TLS: FTP接続オブジェクト
         """
-        ftp = None
+        # TLS使用の場合はFTP_TLS、そうでなければ通常のFTPを使用
+        if self.config["use_tls"]:
+            ftp = ftplib.FTP_TLS(timeout=SOCKET_TIMEOUT)
+            logger.info("Using FTP_TLS connection")
+        else:
+            ftp = ftplib.FTP(timeout=SOCKET_TIMEOUT)
+            logger.info("Using standard FTP connection")
+        
         try:
-            # TLS使用の場合はFTP_TLS、そうでなければ通常のFTPを使用
-            if self.config["use_tls"]:
-                ftp = ftplib.FTP_TLS()
-                logger.info("Using FTP_TLS connection")
-            else:
-                ftp = ftplib.FTP()
-                logger.info("Using standard FTP connection")
-            
             # 接続
-            logger.info(f"Connecting to {self.config['hostname']}:{self.config['port']}")
+            logger.info("Connecting to %s:%s", self.config['hostname'], self.config['port'])
             ftp.connect(self.config["hostname"], self.config["port"])
             
             # ログイン
             ftp.login(self.config["username"], self.config["password"])
-            logger.info(f"Logged in as {self.config['username']}")
+            logger.info("Logged in as %s", self.config['username'])
             
             # TLSの場合はデータ接続の暗号化を有効化
             if self.config["use_tls"]:
@@ -71,64 +93,177 @@ class FTPClient:
             # パッシブモードを有効化（ファイアウォール対応）
             ftp.set_pasv(True)
             
+            # 転送モードはバイナリ固定のため、ログイン時に一度だけ設定
+            ftp.voidcmd('TYPE I')
+            
             # リモートディレクトリに移動
             if self.config["remote_dir"] != "/":
                 ftp.cwd(self.config["remote_dir"])
-                logger.info(f"Changed directory to {self.config['remote_dir']}")
-            
-            yield ftp
-            
-        except ftplib.all_errors as e:
-            logger.error(f"FTP error: {e}")
-            raise
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
+                logger.info("Changed directory to %s", self.config['remote_dir'])
+        except:
+            ftp.close()
             raise
-        finally:
-            if ftp:
+        
+        return ftp
+    
+    def _keepalive(self):
+        """一定時間アイドルだった接続をNOOPで確認し、切断されていれば破棄"""
+        if self._ftp is None or time.monotonic() - self._last_use <= KEEPALIVE_INTERVAL:
+            return
+        try:
+            self._ftp.voidcmd("NOOP")
+        except ftplib.all_errors as e:
+            logger.info("FTP connection is stale, reconnecting: %s", e)
+            self._discard()
+    
+    def _ensure_connected(self):
+        """
+        永続接続を取得（未接続・切断済みの場合は再接続）
+        
+        Returns:
+            ftplib.FTP or ftplib.FTP_TLS: FTP接続オブジェクト
+        """
+        self._keepalive()
+        if self._ftp is None:
+            self._ftp = self._connect()
+        return self._ftp
+    
+    def _discard(self):
+        """エラー後の接続をQUITを送らずに破棄"""
+        if self._ftp:
+            try:
+                self._ftp.close()
+            except:
+                pass
+            self._ftp = None
+    
+    def close(self):
+        """永続接続を終了"""
+        with self._lock:
+            if self._ftp:
                 try:
-                    ftp.quit()
+                    self._ftp.quit()
                     logger.info("FTP connection closed")
                 except:
                     logger.warning("Error closing FTP connection")
+                self._ftp = None
+    
+    @contextmanager
+    def ftp_connection(self):
+        """
+        FTP接続のコンテキストマネージャー
+        接続は終了せずに保持し、次回以降の処理で再利用する
+        
+        Yields:
+            ftplib.FTP or ftplib.FTP_TLS: FTP接続オブジェクト
+        """
+        with self._lock:
+            try:
+                yield self._ensure_connected()
+                self._last_use = time.monotonic()
+            except ftplib.error_perm as e:
+                # 恒久的なエラー応答のみで接続自体は正常なため、接続は保持する
+                logger.error("FTP error: %s", e)
+                self._last_use = time.monotonic()
+                raise
+            except ftplib.all_errors as e:
+                logger.error("FTP error: %s", e)
+                self._discard()
+                raise
+            except Exception as e:
+                logger.error("Unexpected error: %s", e)
+                self._discard()
+                raise
+    
+    def _prepare_payload(self, filename: str, data: bytes) -> Tuple[str, bytes]:
+        """
+        送信用のファイル名とバイト列を準備
+        圧縮送信が有効な場合はgzip圧縮し、ファイル名に.gzを付与する
+        
+        Args:
+            filename: アップロード先のファイル名
+            data: アップロードするバイト列
+            
+        Returns:
+            Tuple[str, bytes]: 送信用のファイル名とバイト列
+        """
+        if self.config.get("compress"):
+            # 通信量削減が目的のため、圧縮レベルは最速の1を使用
+            return self._remote_filename(filename), gzip.compress(data, compresslevel=1)
+        return filename, data
+    
+    def _remote_filename(self, filename: str) -> str:
+        """
+        送信先のファイル名を取得（圧縮送信が有効な場合は.gzを付与）
+        
+        Args:
+            filename: アップロード先のファイル名
+            
+        Returns:
+            str: 送信先のファイル名
+        """
+        return f"{filename}.gz" if self.config.get("compress") else filename
+    
+    def _store(self, filename: str, payload: bytes) -> str:
+        """
+        共有接続でバイト列をアップロード
+        
+        Args:
+            filename: アップロード先のファイル名
+            payload: アップロードするバイト列
+            
+        Returns:
+            str: FTPサーバーの応答
+        """
+        with self.ftp_connection() as ftp:
+            logger.info("Uploading file: %s", filename)
+            # TYPE Iは接続時に設定済みのため、毎回TYPE Iを送るstorbinaryは使わず
+            # データ接続を直接開いてバイト列を1回のsendallで送信
+            with ftp.transfercmd(f'STOR {filename}') as conn:
+                conn.sendall(payload)
+                # TLSの場合はデータ接続のTLSセッションを正しく終了（storbinaryと同じ処理）
+                if isinstance(conn, ssl.SSLSocket):
+                    conn.unwrap()
+            return ftp.voidresp()
     
-    def upload_csv_string(self, csv_content: str, filename: str) -> Dict[str, Any]:
+    def upload_csv_string(self, csv_content: bytes, filename: str) -> Dict[str, Any]:
         """
-        CSV文字列をFTPサーバーにアップロード
+        CSVデータをFTPサーバーにアップロード
         
         Args:
-            csv_content: CSV形式の文字列
+            csv_content: UTF-8でエンコード済みのCSVデータ
             filename: アップロード先のファイル名
             
         Returns:
             Dict[str, Any]: アップロード結果
         """
         try:
-            with self.ftp_connection() as ftp:
-                # CSV文字列をバイトストリームに変換
-                csv_bytes = csv_content.encode('utf-8')
-                csv_stream = io.BytesIO(csv_bytes)
-                
-                # ファイルアップロード
-                logger.info(f"Uploading file: {filename}")
-                result = ftp.storbinary(f'STOR {filename}', csv_stream)
+            # 圧縮送信が有効な場合はgzip圧縮
+            filename, payload = self._prepare_payload(filename, csv_content)
+            
+            # 共有接続が切断されていた場合に備え、一度だけ再接続して再試行
+            try:
+                result = self._store(filename, payload)
+            except _CONNECTION_ERRORS as e:
+                logger.warning("Upload failed, retrying with a new connection: %s", e)
+                result = self._store(filename, payload)
+            
+            if result.startswith('226'):  # 226 = Transfer complete
+                logger.info("Upload successful: %s", filename)
+                return {
+                    "success": True,
+                    "filename": filename,
+                    "size_bytes": len(payload),
+                    "message": "Upload completed successfully"
+                }
+            else:
+                logger.warning("Upload may have failed: %s", result)
+                return {
+                    "success": False,
+                    "filename": filename,
+                    "message": f"Unexpected FTP response: {result}"
+                }
                 
-                if result.startswith('226'):  # 226 = Transfer complete
-                    logger.info(f"Upload successful: {filename}")
-                    return {
-                        "success": True,
-                        "filename": filename,
-                        "size_bytes": len(csv_bytes),
-                        "message": "Upload completed successfully"
-                    }
-                else:
-                    logger.warning(f"Upload may have failed: {result}")
-                    return {
-                        "success": False,
-                        "filename": filename,
-                        "message": f"Unexpected FTP response: {result}"
-                    }
-                    
         except ftplib.all_errors as e:
             error_msg = f"FTP upload failed: {e}"
             logger.error(error_msg)
@@ -148,6 +283,98 @@ class FTPClient:
                 "message": error_msg
             }
     
+    def upload_many(self, files: List[Tuple[str, bytes]], skip_existing: bool = False) -> Dict[str, Any]:
+        """
+        複数のCSVファイルを1つのFTPセッションでまとめてアップロード
+        途中で失敗した場合は残りのファイルの送信を中止する
+        
+        Args:
+            files: (ファイル名, UTF-8でエンコード済みのCSVデータ)のリスト
+            skip_existing: Trueの場合、リモートに同名ファイルがあるものは送信しない
+            
+        Returns:
+            Dict[str, Any]: アップロード結果
+        """
+        results = []
+        skipped = []
+        # 送信中に他の処理が接続へ割り込まないよう、全件の送信が終わるまでロックを保持
+        with self._lock:
+            existing = self._remote_file_names() if skip_existing else set()
+            for filename, csv_content in files:
+                if self._remote_filename(filename) in existing:
+                    skipped.append(filename)
+                    continue
+                result = self.upload_csv_string(csv_content, filename)
+                results.append(result)
+                if not result["success"]:
+                    break
+        
+        uploaded_count = sum(1 for result in results if result["success"])
+        success = uploaded_count + len(skipped) == len(files)
+        if success:
+            message = f"Uploaded {uploaded_count} files, skipped {len(skipped)} existing files"
+        else:
+            message = f"Upload stopped after {uploaded_count} of {len(files) - len(skipped)} files"
+        
+        return {
+            "success": success,
+            "uploaded_count": uploaded_count,
+            "skipped_count": len(skipped),
+            "total_count": len(files),
+            "results": results,
+            "message": message
+        }
+    
+    def _remote_file_names(self) -> Set[str]:
+        """
+        リモートディレクトリのファイル名一覧を取得
+        取得できない場合は空として扱う（全件送信になるが、同じ時刻枠は同じデータのため上書きしても問題ない）
+        
+        Returns:
+            Set[str]: ファイル名の集合
+        """
+        try:
+            with self.ftp_connection() as ftp:
+                # サーバーによってはパス付きで返すため、ファイル名部分のみを使用
+                return {name.rsplit('/', 1)[-1] for name in self._list_files(ftp)}
+        except ftplib.all_errors as e:
+            logger.warning("Unable to list remote files, uploading all: %s", e)
+            return set()
+    
+    def _list_files(self, ftp, limit: Optional[int] = None) -> List[str]:
+        """
+        ディレクトリのファイル名を先頭から指定件数だけ取得
+        上限に達した時点でデータ接続を閉じ、残りの一覧は受信しない
+        
+        Args:
+            ftp: FTP接続オブジェクト
+            limit: 取得する最大件数（Noneの場合は全件）
+            
+        Returns:
+            List[str]: ファイル名のリスト
+        """
+        file_list = []
+        
+        def collect(line):
+            file_list.append(line)
+            if limit is not None and len(file_list) >= limit:
+                raise _ListingLimitReached
+        
+        try:
+            ftp.retrlines('NLST', collect)
+        except _ListingLimitReached:
+            # 転送を途中で打ち切ったため、サーバーの完了応答（226または426）を
+            # 読み捨てて共有接続のコマンド・応答の対応を保つ
+            try:
+                ftp.voidresp()
+            except ftplib.error_temp:
+                pass
+        finally:
+            # retrlinesはTYPE Aに切り替えるため、共有接続をバイナリモードに戻す
+            ftp.voidcmd('TYPE I')
+        
+        return file_list
+    
     def test_connection(self) -> Dict[str, Any]:
         """
         FTP接続のテスト
@@ -163,7 +390,7 @@ class FTPClient:
                 # ディレクトリリストを取得（最初の5つのみ）
                 file_list = []
                 try:
-                    file_list = ftp.nlst()[:5]
+                    file_list = self._list_files(ftp, limit=5)
                 except:
                     file_list = ["(unable to list files)"]
                 
@@ -197,30 +424,72 @@ class FTPClient:
         try:
             with self.ftp_connection() as ftp:
                 try:
+                    # 共有接続の作業ディレクトリを変えないよう確認後に元へ戻す
+                    original_dir = ftp.pwd()
                     ftp.cwd(directory)
-                    logger.info(f"Directory already exists: {directory}")
+                    ftp.cwd(original_dir)
+                    logger.info("Directory already exists: %s", directory)
                     return True
                 except ftplib.error_perm:
                     # ディレクトリが存在しない場合は作成
                     ftp.mkd(directory)
-                    logger.info(f"Created directory: {directory}")
+                    logger.info("Created directory: %s", directory)
                     return True
                     
         except Exception as e:
-            logger.error(f"Failed to create directory {directory}: {e}")
+            logger.error("Failed to create directory %s: %s", directory, e)
             return False
 
-def upload_csv_to_ftp(csv_content: str, filename: str, config: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+_shared_client: Optional[FTPClient] = None
+_shared_client_lock = threading.Lock()
+
+def get_shared_client() -> FTPClient:
     """
-    CSV文字列をFTPサーバーにアップロードする便利関数
+    環境変数の設定で初期化した共有FTPクライアントを取得
+    ウォームスタート時は前回の接続をそのまま再利用する
+    
+    Returns:
+        FTPClient: 共有FTPクライアント
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = FTPClient()
+        return _shared_client
+
+def upload_csv_to_ftp(csv_content: bytes, filename: str, config: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    CSVデータをFTPサーバーにアップロードする便利関数
     
     Args:
-        csv_content: CSV形式の文字列
+        csv_content: UTF-8でエンコード済みのCSVデータ
         filename: アップロード先のファイル名
-        config: FTP接続設定（Noneの場合は環境変数から取得）
+        config: FTP接続設定（Noneの場合は環境変数から取得し、共有接続を使用）
         
     Returns:
         Dict[str, Any]: アップロード結果
     """
+    if config is None:
+        return get_shared_client().upload_csv_string(csv_content, filename)
+    
     ftp_client = FTPClient(config)
-    return ftp_client.upload_csv_string(csv_content, filename)
\ No newline at end of file
+    try:
+        return ftp_client.upload_csv_string(csv_content, filename)
+    finally:
+        ftp_client.close()
+
+
+async def upload_csv_to_ftp_async(csv_content: bytes, filename: str, config: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    upload_csv_to_ftpの非同期版
+    共有接続を使ったアップロードをワーカースレッドで実行し、イベントループをブロックしない
+    
+    Args:
+        csv_content: UTF-8でエンコード済みのCSVデータ
+        filename: アップロード先のファイル名
+        config: FTP接続設定（Noneの場合は環境変数から取得し、共有接続を使用）
+        
+    Returns:
+        Dict[str, Any]: アップロード結果
+    """
+    return await asyncio.to_thread(upload_csv_to_ftp, csv_content, filename, config)